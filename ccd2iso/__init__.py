@@ -4,18 +4,52 @@
 
 """Tool to convert CloneCD .img files to ISO 9660 .iso files."""
 
-from typing import Any
-from io import BytesIO
+from typing import Any, BinaryIO, Callable, Optional
 import contextlib
-import tkinter.filedialog as fileDialog
 import os
-import progressbar
 from ctypes import c_ubyte, Structure, Union, sizeof
 import sys
+import time
+import queue
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 
 __version__ = "0.0.1"
 DATA_SIZE = 2048
 
+# Byte offsets into a raw sector, matching the structures below
+MODE_OFFSET = 15
+MODE1_DATA_OFFSET = 16
+MODE2_DATA_OFFSET = 24
+
+# Payload offset for each supported sector mode
+_MODE_DATA_OFFSET = {
+    1: MODE1_DATA_OFFSET,
+    2: MODE2_DATA_OFFSET,
+}
+
+# Mode byte of a session marker sector
+SESSION_MARKER = 0xE2
+
+# Number of sectors read from the source per read() call
+BATCH_SECTORS = 512
+
+# Mode bytes of a batch made up entirely of sectors of a single mode, and the
+# payload offset used for such a batch
+_HOMOGENEOUS_BATCHES = {
+    mode: (memoryview(bytes([mode]) * BATCH_SECTORS), data_offset)
+    for mode, data_offset in _MODE_DATA_OFFSET.items()
+}
+
+# Number of input and output buffers in flight between the IO threads
+PIPELINE_DEPTH = 3
+
+# Buffer size used when opening the source and destination files
+IO_BUFFER_SIZE = 1 << 20
+
+# Minimum number of seconds between two redraws of the progress line
+PROGRESS_INTERVAL = 0.1
+
 #
 # Structures
 #
@@ -61,12 +95,18 @@ class ccd_content(Union):
     ]
 
 class ccd_sector(Structure):
-    """Individual sector in the disc image."""
+    """Individual sector in the disc image.
+
+    Kept as documentation of the sector layout; convert() indexes raw bytes
+    at the offsets defined above instead of instantiating these structures.
+    """
     _fields_ = [
         ('sectheader', ccd_sectheader),
         ('content', ccd_content),
     ]
 
+SECTOR_SIZE = sizeof(ccd_sector)
+
 #
 # Exceptions
 #
@@ -91,79 +131,284 @@ class UnrecognizedSectorModeError(Exception):
 # Functions
 #
 
-def convert(src_file: BytesIO, dst_file: BytesIO, progress: bool = False, size: int = None) -> None:
+def _copy_payloads(src: memoryview, dst: memoryview, data_offset: int, count: int) -> int:
+    """Copies the payload of count sectors, all of the same mode, from src to dst.
+
+    Returns the number of bytes written to dst.
+    """
+    written = 0
+    for offset in range(data_offset, data_offset + count * SECTOR_SIZE, SECTOR_SIZE):
+        dst[written:written + DATA_SIZE] = src[offset:offset + DATA_SIZE]
+        written += DATA_SIZE
+    return written
+
+def _extract_sectors(src: memoryview, dst: memoryview, count: int) -> int:
+    """Copies the payload of up to count sectors of mixed modes from src to dst.
+
+    Stops at the first sector in a mode missing from _MODE_DATA_OFFSET, leaving
+    the error reporting to the caller. Returns the number of sectors copied.
+    """
+    written = 0
+    for offset in range(0, count * SECTOR_SIZE, SECTOR_SIZE):
+        data_offset = _MODE_DATA_OFFSET.get(src[offset + MODE_OFFSET])
+        if data_offset is None:
+            return written // DATA_SIZE
+
+        data_offset += offset
+        dst[written:written + DATA_SIZE] = src[data_offset:data_offset + DATA_SIZE]
+        written += DATA_SIZE
+    return count
+
+# Use the compiled kernels when ccd2iso/_extract.pyx has been built
+try:
+    from ._extract import copy_payloads as _copy_payloads, extract_sectors as _extract_sectors
+except ImportError:
+    pass
+
+def _advise_sequential(file: BinaryIO) -> None:
+    """Hints the OS to read ahead aggressively, where posix_fadvise is available."""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+def _read_chunk(src_file: BinaryIO, buffer: memoryview) -> int:
+    """Fills buffer from src_file, retrying short reads until the end of file.
+
+    Returns the number of bytes read, which is only less than the size of
+    buffer at the end of the file.
+    """
+    length = 0
+    while length < len(buffer):
+        bytes_read = src_file.readinto(buffer[length:])
+        if not bytes_read:
+            break
+        length += bytes_read
+    return length
+
+def _reader(src_file: BinaryIO, free: queue.Queue, filled: queue.Queue) -> None:
+    """Reads batches from src_file into buffers taken from free, and hands them to filled.
+
+    Stops at the end of file or when None is taken from free. Errors are passed
+    on through filled as well as raised.
+    """
+    try:
+        while (chunk := free.get()) is not None:
+            length = _read_chunk(src_file, chunk)
+            filled.put((chunk, length))
+            if not length:
+                break
+    except BaseException as error:
+        filled.put(error)
+        raise
+
+def _writer(dst_file: BinaryIO, filled: queue.Queue, free: queue.Queue) -> None:
+    """Writes buffers taken from filled to dst_file, and returns them to free.
+
+    Stops when None is taken from filled. Errors are passed on through free as
+    well as raised.
+    """
+    try:
+        while (item := filled.get()) is not None:
+            out, written = item
+
+            # Unbuffered files may write less than requested
+            pending = out[:written]
+            while pending:
+                pending = pending[dst_file.write(pending):]
+            free.put(out)
+    except BaseException as error:
+        free.put(error)
+        raise
+
+def _read_batches(src_file: BinaryIO, executor: ThreadPoolExecutor):
+    """Yields (buffer, length) batches read ahead from src_file on a reader thread.
+
+    Each buffer is reused for a later batch once the next one is requested.
+    """
+    free, filled = queue.Queue(), queue.Queue()
+    for _ in range(PIPELINE_DEPTH):
+        free.put(memoryview(bytearray(BATCH_SECTORS * SECTOR_SIZE)))
+
+    executor.submit(_reader, src_file, free, filled)
+    try:
+        while True:
+            item = filled.get()
+            if isinstance(item, BaseException):
+                raise item
+            chunk, length = item
+            if not length:
+                return
+            yield chunk, length
+            free.put(chunk)
+    finally:
+        # Stop the reader
+        free.put(None)
+
+def _map_batches(src_map: mmap.mmap):
+    """Yields (buffer, length) batches as slices of src_map, without copying.
+
+    Each slice is released once the next batch is requested, so src_map can be
+    closed after the generator is exhausted or closed.
+    """
+    chunk_size = BATCH_SECTORS * SECTOR_SIZE
+    with memoryview(src_map) as view:
+        for start in range(0, len(view), chunk_size):
+            with view[start:start + chunk_size] as chunk:
+                yield chunk, len(chunk)
+
+def convert(src_file: BinaryIO, dst_file: BinaryIO, progress_cb: Optional[Callable[[int], None]] = None) -> None:
     """Converts a CloneCD disc image bytestream to an ISO 9660 bytestream.
 
-    src_file -- CloneCD disc image bytestream (typically with a .img extension)
+    src_file -- CloneCD disc image bytestream (typically with a .img extension),
+                or an mmap of it to convert without copying the image
     dst_file -- destination bytestream to write to in ISO 9660 format
-    progress -- whether to output a progress bar to stdout
-    size -- size of src_file, used to calculate sectors remaining for progress
+    progress_cb -- called with the number of sectors converted so far, after
+                   every batch
     """
 
     sect_num = 0
-    expected_size = sizeof(ccd_sector)
-    max_value = int(size / expected_size) if size else progressbar.UnknownLength
-    print(max_value, progress)
 
-    # Initialize progress bar if enabled
-    progress_bar = progressbar.ProgressBar(maxval=max_value) if progress else None
-    if progress_bar:
-        progress_bar.start()
+    # Buffers are allocated once and passed around as memoryviews between the
+    # reader thread, this thread and the writer thread, so reading, converting
+    # and writing consecutive batches overlap without copying or allocating
+    free_outs, filled_outs = queue.Queue(), queue.Queue()
+    for _ in range(PIPELINE_DEPTH):
+        free_outs.put(memoryview(bytearray(BATCH_SECTORS * DATA_SIZE)))
 
-    try:
-        while bytes_read := src_file.read(expected_size):
-            src_sect = ccd_sector.from_buffer_copy(bytes_read)
-            if sizeof(src_sect) < expected_size:
-                raise IncompleteSectorError(
-                    'Error: Sector %d is incomplete, with only %d bytes instead of %d. This might not be a CloneCD disc image.' %
-                    (sect_num, sizeof(src_sect), expected_size))
-
-            if src_sect.sectheader.header.mode == 1:
-                bytes_written = dst_file.write(src_sect.content.mode1.data)
-            elif src_sect.sectheader.header.mode == 2:
-                bytes_written = dst_file.write(src_sect.content.mode2.data)
-            elif src_sect.sectheader.header.mode == b'\xe2':
-                raise SessionMarkerError('Error: Found a session marker, this image might contain multisession data. Only the first session was exported.')
-            else:
-                raise UnrecognizedSectorModeError('Error: Unrecognized sector mode (%x) at sector %d!' % (src_sect.sectheader.header.mode, sect_num))
-
-            sect_num += 1
-
-            # Update progress bar if enabled
-            if progress_bar:
-                progress_bar.update(sect_num)
-    finally:
-        # Finish progress bar if enabled
-        if progress_bar:
-            progress_bar.finish()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        writer = executor.submit(_writer, dst_file, filled_outs, free_outs)
+        if isinstance(src_file, mmap.mmap):
+            batches = _map_batches(src_file)
+        else:
+            batches = _read_batches(src_file, executor)
+
+        try:
+            for chunk_view, length in batches:
+                out_view = free_outs.get()
+                if isinstance(out_view, BaseException):
+                    raise out_view
+
+                # Sizes are checked with plain integer arithmetic up front; error
+                # messages are only formatted once an error is actually raised
+                count, remainder = divmod(length, SECTOR_SIZE)
+                written = 0
+                try:
+                    # Guess the mode of the whole batch from its first sector, check
+                    # it against every sector with one strided comparison, and skip
+                    # per-sector dispatch when the batch is homogeneous
+                    homogeneous = _HOMOGENEOUS_BATCHES.get(chunk_view[MODE_OFFSET]) if count else None
+                    if homogeneous and chunk_view[MODE_OFFSET:count * SECTOR_SIZE:SECTOR_SIZE] == homogeneous[0][:count]:
+                        written = _copy_payloads(chunk_view, out_view, homogeneous[1], count)
+                        sect_num += count
+                    else:
+                        converted = _extract_sectors(chunk_view, out_view, count)
+                        written = converted * DATA_SIZE
+                        sect_num += converted
+
+                        if converted < count:
+                            mode = chunk_view[converted * SECTOR_SIZE + MODE_OFFSET]
+                            if mode == SESSION_MARKER:
+                                raise SessionMarkerError('Error: Found a session marker, this image might contain multisession data. Only the first session was exported.')
+                            else:
+                                raise UnrecognizedSectorModeError('Error: Unrecognized sector mode (%x) at sector %d!' % (mode, sect_num))
+
+                    if remainder:
+                        raise IncompleteSectorError(
+                            'Error: Sector %d is incomplete, with only %d bytes instead of %d. This might not be a CloneCD disc image.' %
+                            (sect_num, remainder, SECTOR_SIZE))
+                finally:
+                    # Flush the sectors converted so far, even if the batch failed
+                    filled_outs.put((out_view, written))
+
+                # Report progress if requested, once per batch rather than
+                # once per sector
+                if progress_cb:
+                    progress_cb(sect_num)
+        finally:
+            # Stop reading, and let the writer drain the remaining batches
+            batches.close()
+            filled_outs.put(None)
+
+    # Raise errors from the last writes
+    writer.result()
+
+def convert_file(src_path: str, dst_path: str, progress_cb: Optional[Callable[[int], None]] = None) -> None:
+    """Converts a CloneCD disc image file to an ISO 9660 file.
+
+    The image is memory-mapped when possible, and the destination is written
+    without an extra layer of buffering, as convert() already writes in batches.
+
+    src_path -- path of the CloneCD disc image (typically with a .img extension)
+    dst_path -- path of the ISO 9660 file to create or overwrite
+    progress_cb -- called with the number of sectors converted so far, after
+                   every batch
+    """
+    with open(src_path, 'rb', buffering=IO_BUFFER_SIZE) as src_file, open(dst_path, 'wb', buffering=0) as dst_file:
+        try:
+            src_map = mmap.mmap(src_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Empty files, and files on some filesystems, can't be mapped
+            _advise_sequential(src_file)
+            convert(src_file, dst_file, progress_cb)
+            return
+
+        with src_map:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                src_map.madvise(mmap.MADV_SEQUENTIAL)
+            convert(src_map, dst_file, progress_cb)
+
+def _progress_printer(total: int) -> Callable[[int], None]:
+    """Returns a progress_cb that redraws a progress line on stderr.
+
+    Redraws are throttled to one per PROGRESS_INTERVAL, except for the last one.
+    total -- number of sectors expected, or 0 if unknown
+    """
+    last_draw = 0.0
+
+    def draw(sect_num: int) -> None:
+        nonlocal last_draw
+        now = time.monotonic()
+        if now - last_draw < PROGRESS_INTERVAL and sect_num < total:
+            return
+        last_draw = now
+
+        if total:
+            sys.stderr.write('\r%d/%d sectors (%.1f%%)' % (sect_num, total, 100 * sect_num / total))
+        else:
+            sys.stderr.write('\r%d sectors' % sect_num)
+        sys.stderr.flush()
+
+    return draw
 
 def main():
+    # GUI dependencies are only needed for the command line tool
+    import tkinter.filedialog as fileDialog
+
     # Check source file
-    src_file = fileDialog.askopenfile(mode='r', filetypes=[("CloneCD Image", "*.img")])
-    dst_file = None
+    src_path = fileDialog.askopenfilename(filetypes=[("CloneCD Image", "*.img")])
 
     # ask for source file
-    if not src_file:
+    if not src_path:
         print('Error: No file selected.')
         sys.exit(0)
     else:
-        print('Source file:', src_file.name)
+        print('Source file:', src_path)
 
     # ask if user wants to create a new .iso file in the same directory
     if input('Create new .iso file in the same directory? (y/n) ').lower() == 'y':
         import tempfile
         # get current directory
-        current_dir = os.path.dirname(src_file.name)
-        dst_file = tempfile.NamedTemporaryFile(dir = current_dir, delete=False)
-        print('Destination file:', dst_file.name, 'Current Directory:', current_dir)
+        current_dir = os.path.dirname(src_path)
+        dst_fd, dst_path = tempfile.mkstemp(dir=current_dir)
+        os.close(dst_fd)
+        print('Destination file:', dst_path, 'Current Directory:', current_dir)
     else:
         # ask for destination file
-        dst_file = fileDialog.asksaveasfile(mode='wb', defaultextension='.iso', filetypes=[("ISO 9660 Image", "*.iso")])
-        if not dst_file:
+        dst_path = fileDialog.asksaveasfilename(defaultextension='.iso', filetypes=[("ISO 9660 Image", "*.iso")])
+        if not dst_path:
             print('Error: No file selected.')
             sys.exit(0)
         else:
-            print('Destination file:', dst_file.name)
+            print('Destination file:', dst_path)
 
     # Run conversion
     try:
@@ -173,27 +418,38 @@ def main():
         else:
             runQuiet = False
         print('Converting...')
-        convert(src_file, dst_file, progress=not runQuiet, size = os.path.getsize(src_file.name))
+
+        # Initialize progress line if enabled
+        progress_cb = None
+        if not runQuiet:
+            progress_cb = _progress_printer(os.path.getsize(src_path) // SECTOR_SIZE)
+            progress_cb(0)
+
+        try:
+            convert_file(src_path, dst_path, progress_cb=progress_cb)
+        finally:
+            # End progress line if enabled
+            if progress_cb:
+                sys.stderr.write('\n')
+    except SessionMarkerError as error:
+        # The sectors before the marker are a complete first session, so keep them
+        print(error)
     except KeyboardInterrupt:
         print('Cancelled.')
-        dst_file.close()
-        os.remove(dst_file.name)
+        os.remove(dst_path)
         sys.exit(1)
     except Exception as error:
         print(error)
-        dst_file.close()
-        os.remove(dst_file.name)
+        os.remove(dst_path)
         sys.exit(1)
 
     # Clean up
-    src_file.close()
-    dst_file.close()
     try:
-        os.replace(dst_file.name, src_file.name + '.iso')
+        os.replace(dst_path, src_path + '.iso')
     except PermissionError:
-        print("Error: Couldn't overwrite", dst_file.name, "with", src_file.name + '.iso')  
+        print("Error: Couldn't overwrite", dst_path, "with", src_path + '.iso')  
         print('The .iso file might be mounted or marked read-only.')
-        print(dst_file.name, 'contains the ISO data')
+        print(dst_path, 'contains the ISO data')
     print('Done.')
 
 if __name__ == '__main__':
@@ -0,0 +1,59 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# cython: language_level=3, boundscheck=False, wraparound=False
+
+"""Compiled versions of the sector extraction kernels in ccd2iso.
+
+Build in place with `cythonize -i ccd2iso/_extract.pyx`. ccd2iso falls back to
+its pure Python kernels when this module isn't built.
+"""
+
+from libc.string cimport memcpy
+
+# Must match the constants in ccd2iso/__init__.py
+cdef Py_ssize_t SECTOR_SIZE = 2352
+cdef Py_ssize_t DATA_SIZE = 2048
+cdef Py_ssize_t MODE_OFFSET = 15
+cdef Py_ssize_t MODE1_DATA_OFFSET = 16
+cdef Py_ssize_t MODE2_DATA_OFFSET = 24
+
+def copy_payloads(const unsigned char[::1] src, unsigned char[::1] dst, Py_ssize_t data_offset, Py_ssize_t count) -> int:
+    """Copies the payload of count sectors, all of the same mode, from src to dst.
+
+    Returns the number of bytes written to dst.
+    """
+    if count * SECTOR_SIZE > src.shape[0] or count * DATA_SIZE > dst.shape[0]:
+        raise ValueError('Buffers are too small for %d sectors' % count)
+
+    cdef Py_ssize_t i
+    with nogil:
+        for i in range(count):
+            memcpy(&dst[i * DATA_SIZE], &src[i * SECTOR_SIZE + data_offset], DATA_SIZE)
+    return count * DATA_SIZE
+
+def extract_sectors(const unsigned char[::1] src, unsigned char[::1] dst, Py_ssize_t count) -> int:
+    """Copies the payload of up to count sectors of mixed modes from src to dst.
+
+    Stops at the first sector that isn't in mode 1 or mode 2, leaving the error
+    reporting to the caller. Returns the number of sectors copied.
+    """
+    if count * SECTOR_SIZE > src.shape[0] or count * DATA_SIZE > dst.shape[0]:
+        raise ValueError('Buffers are too small for %d sectors' % count)
+
+    cdef Py_ssize_t i, data_offset
+    cdef Py_ssize_t converted = count
+    cdef unsigned char mode
+    with nogil:
+        for i in range(count):
+            mode = src[i * SECTOR_SIZE + MODE_OFFSET]
+            if mode == 1:
+                data_offset = MODE1_DATA_OFFSET
+            elif mode == 2:
+                data_offset = MODE2_DATA_OFFSET
+            else:
+                converted = i
+                break
+            memcpy(&dst[i * DATA_SIZE], &src[i * SECTOR_SIZE + data_offset], DATA_SIZE)
+    return converted